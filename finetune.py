@@ -1,17 +1,26 @@
-import copy
+import concurrent.futures
+import hashlib
 import json
 import logging
 import os
+import tempfile
 
 import torch
-from torch.utils.data import Dataset
+import torch.nn.functional as F
+from torch.utils.data import Dataset, Sampler
 from dataclasses import dataclass
 
 from llama.tokenizer import Tokenizer
 from llama.model import ModelArgs, Llama
-from torch.cuda.amp import autocast, GradScaler
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 IGNORE_INDEX = -100
+# Bump whenever preprocess() output changes so stale tokenized caches are not reused
+TOKENIZED_CACHE_VERSION = 2
 
 PROMPT_DICT = {
     "prompt_input": (
@@ -27,15 +36,13 @@ PROMPT_DICT = {
 }
 
 
-def _tokenize_fn(strings, tokenizer):
+def _tokenize_fn(strings, tokenizer, bos=True, eos=True):
     """Tokenize a list of strings."""
     tokenized_list = [
-        torch.tensor(tokenizer.encode(text, bos=True, eos=True)) for text in strings
+        torch.tensor(tokenized, dtype=torch.long) for tokenized in tokenizer.encode_batch(strings, bos=bos, eos=eos)
     ]
     input_ids = labels = [tokenized for tokenized in tokenized_list]
-    input_ids_lens = labels_lens = [
-        tokenized.ne(-1).sum().item() for tokenized in tokenized_list
-    ]
+    input_ids_lens = labels_lens = [tokenized.size(0) for tokenized in tokenized_list]
     return dict(
         input_ids=input_ids,
         labels=labels,
@@ -46,13 +53,67 @@ def _tokenize_fn(strings, tokenizer):
 
 def preprocess(sources, targets, tokenizer):
     """Preprocess the data by tokenizing."""
-    examples = [s + t for s, t in zip(sources, targets)]
-    examples_tokenized, sources_tokenized = [_tokenize_fn(strings, tokenizer) for strings in (examples, sources)]
-    input_ids = examples_tokenized["input_ids"]
-    labels = copy.deepcopy(input_ids)
-    for label, source_len in zip(labels, sources_tokenized["input_ids_lens"]):
-        label[:source_len-1] = IGNORE_INDEX
-    return dict(input_ids=input_ids, labels=labels)
+    # Tokenize each half once; the source gets BOS and the target gets EOS,
+    # so splicing them yields the full example and its source length for free.
+    sources_tokenized = _tokenize_fn(sources, tokenizer, bos=True, eos=False)
+    targets_tokenized = _tokenize_fn(targets, tokenizer, bos=False, eos=True)
+    source_lens = torch.tensor(sources_tokenized["input_ids_lens"])
+    lengths = source_lens + torch.tensor(targets_tokenized["input_ids_lens"])
+    flat_input_ids = torch.cat([
+        ids for pair in zip(sources_tokenized["input_ids"], targets_tokenized["input_ids"]) for ids in pair
+    ])
+
+    # Scatter all examples into one padded (N, max_len) int32 tensor; boolean-mask assignment fills
+    # row-major, which matches the concatenation order. The vocab fits comfortably in int32.
+    positions = torch.arange(int(lengths.max()))
+    in_sequence = positions < lengths[:, None]
+    input_ids = torch.full(in_sequence.shape, -1, dtype=torch.int32)
+    input_ids[in_sequence] = flat_input_ids.to(torch.int32)
+
+    # Mask every source position and all padding in one vectorized op
+    labels = input_ids.masked_fill((positions < source_lens[:, None]) | ~in_sequence, IGNORE_INDEX)
+    return dict(input_ids=input_ids, labels=labels, lengths=lengths)
+
+
+def shifted_cross_entropy(
+    logits: torch.Tensor, labels: torch.Tensor, accumulation_steps: int, ignore_index: int = IGNORE_INDEX
+) -> torch.Tensor:
+    """Next-token cross-entropy, averaged over unmasked labels and scaled for gradient accumulation."""
+    # Shift the labels left instead of slicing the logits: logits[:, :-1] is not viewable as 2D for
+    # batches of more than one sequence, so flattening it would copy the whole vocab-wide tensor
+    shift_labels = F.pad(labels[:, 1:], (0, 1), value=ignore_index)
+    return F.cross_entropy(
+        logits.view(-1, logits.size(-1)), shift_labels.view(-1), ignore_index=ignore_index
+    ) / accumulation_steps
+
+
+def _tokenized_cache_path(data_path, tokenizer):
+    """Path of the tokenized dataset cache, keyed on the data and tokenizer files."""
+    key = "|".join([
+        str(TOKENIZED_CACHE_VERSION),
+        os.path.abspath(data_path),
+        str(os.path.getmtime(data_path)),
+        os.path.abspath(tokenizer.model_path),
+        str(os.path.getmtime(tokenizer.model_path)),
+    ])
+    return f"{data_path}.tok.{hashlib.md5(key.encode()).hexdigest()}.pt"
+
+
+def _save_tokenized_cache(data_dict, cache_path):
+    """Write the tokenized cache atomically; failing to write it only costs re-tokenizing next run."""
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(cache_path) + ".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(cache_path))
+        )
+        with os.fdopen(fd, "wb") as f:
+            torch.save(data_dict, f)
+        # a reader either sees no cache or a complete one, never a truncated file
+        os.replace(tmp_path, cache_path)
+    except (OSError, RuntimeError) as e:
+        logging.warning(f"Could not write tokenized cache to {cache_path}: {e}")
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 class SupervisedDataset(Dataset):
@@ -60,9 +121,28 @@ class SupervisedDataset(Dataset):
 
     def __init__(self, data_path, tokenizer):
         super(SupervisedDataset, self).__init__()
+        cache_path = _tokenized_cache_path(data_path, tokenizer)
+        if os.path.exists(cache_path):
+            logging.warning(f"Loading tokenized data from {cache_path}...")
+            data_dict = torch.load(cache_path, mmap=True, weights_only=True)
+        else:
+            data_dict = self._tokenize(data_path, tokenizer)
+            _save_tokenized_cache(data_dict, cache_path)
+
+        # Rows are padded with -1 / IGNORE_INDEX out to the longest example
+        self.input_ids = data_dict["input_ids"]
+        self.labels = data_dict["labels"]
+        self.lengths = data_dict["lengths"]
+
+    @staticmethod
+    def _tokenize(data_path, tokenizer):
         logging.warning("Loading data...")
-        with open(data_path, "r") as f:
-            list_data_dict = json.load(f)
+        if orjson is not None:
+            with open(data_path, "rb") as f:
+                list_data_dict = orjson.loads(f.read())
+        else:
+            with open(data_path, "r") as f:
+                list_data_dict = json.load(f)
 
         logging.warning("Formatting inputs...")
         prompt_input, prompt_no_input = PROMPT_DICT["prompt_input"], PROMPT_DICT["prompt_no_input"]
@@ -73,34 +153,103 @@ class SupervisedDataset(Dataset):
         targets = [f"{example['output']}" for example in list_data_dict]
 
         logging.warning("Tokenizing inputs... This may take some time...")
-        data_dict = preprocess(sources, targets, tokenizer)
-
-        self.input_ids = data_dict["input_ids"]
-        self.labels = data_dict["labels"]
+        return preprocess(sources, targets, tokenizer)
 
     def __len__(self):
         return len(self.input_ids)
 
     def __getitem__(self, i):
-        return dict(input_ids=self.input_ids[i], labels=self.labels[i])
+        return dict(input_ids=self.input_ids[i], labels=self.labels[i], length=self.lengths[i])
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """Batch together examples of similar length to keep padding small.
+
+    Indices are shuffled and split into chunks of `batch_size * chunk_multiplier`; each chunk is
+    sorted by length and cut into batches, and the batches are shuffled again before being yielded.
+    """
+    def __init__(self, lengths, batch_size, chunk_multiplier=100):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.chunk_size = batch_size * chunk_multiplier
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths)).tolist()
+        batches = []
+        for start in range(0, len(indices), self.chunk_size):
+            chunk = sorted(indices[start:start + self.chunk_size], key=lambda i: self.lengths[i])
+            batches.extend(chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size))
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i]
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
 
 
 @dataclass
 class DataCollatorForSupervisedDataset(object):
     """Collate examples for supervised fine-tuning."""
+    # Round the padded length up so fp16/bf16 matmuls hit the Tensor Core shapes
+    pad_to_multiple_of: int = 8
+
     def __call__(self, instances):
-        input_ids, labels = tuple([instance[key] for instance in instances] for key in ("input_ids", "labels"))
-        input_ids = torch.nn.utils.rnn.pad_sequence(
-            input_ids, batch_first=True, padding_value=-1
+        # Dataset rows are already padded, so a batch is just the leading columns of each row
+        seq_len = max(int(instance["length"]) for instance in instances)
+        seq_len += -seq_len % self.pad_to_multiple_of
+        input_ids, labels = tuple(
+            torch.stack([instance[key][:seq_len] for instance in instances]).long()
+            for key in ("input_ids", "labels")
         )
-        labels = torch.nn.utils.rnn.pad_sequence(labels, batch_first=True, padding_value=IGNORE_INDEX)
+
+        # rows shorter than the rounded-up length only occur for the dataset's longest examples
+        extra = seq_len - input_ids.size(1)
+        if extra:
+            input_ids = F.pad(input_ids, (0, extra), value=-1)
+            labels = F.pad(labels, (0, extra), value=IGNORE_INDEX)
+        # -1 is not a valid embedding index; pads sit after every real token and their labels are
+        # ignored, so any in-vocab id works as a placeholder under causal attention
+        attention_mask = input_ids.ne(-1)
         return dict(
-            input_ids=input_ids,
+            input_ids=input_ids.masked_fill(~attention_mask, 0),
             labels=labels,
-            attention_mask=input_ids.ne(-1),
+            attention_mask=attention_mask,
         )
 
 
+class CudaPrefetcher:
+    """Wrap a DataLoader so each batch is copied to the GPU on a side stream.
+
+    The copy of batch i + 1 is issued as soon as batch i is handed out, so it overlaps with the
+    forward/backward of batch i; the default stream only waits on it right before the batch is used.
+    """
+    def __init__(self, loader, device="cuda"):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        batch = next(it, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+
+    def __iter__(self):
+        it = iter(self.loader)
+        next_batch = self._preload(it)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            for v in batch.values():
+                # tensors were allocated on the side stream; keep the allocator from reusing them early
+                v.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(it)
+            yield batch
+
+
 def make_supervised_data_module(tokenizer, data_path):
     """Make dataset and collator for supervised fine-tuning."""
     train_dataset = SupervisedDataset(tokenizer=tokenizer, data_path=data_path)
@@ -116,26 +265,40 @@ def train():
     tokenizer_path = "/home1/ichuncha/llama/llama2-7b/tokenizer.model"
     data_path = "/home1/ichuncha/llama/alpaca_data_200.json"
 
-    # load model
-    checkpoint = torch.load(model_path, map_location="cpu")
-    model_args = ModelArgs()
-    model_args.n_layers = 32  # for debugging purposes we only use 1 layer
-    # torch.set_default_tensor_type(torch.cuda.HalfTensor) # for training we use fp32 weights
-    model = Llama(model_args)
-    model.load_state_dict(checkpoint, strict=False)
-    model.to("cuda")
-
     # load tokenizer
     tokenizer = Tokenizer(tokenizer_path)
 
+    # tokenize the dataset in the background while the checkpoint is read and the model is built;
+    # torch.load and the tensor copies release the GIL, so the two overlap
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        data_module_future = executor.submit(make_supervised_data_module, tokenizer=tokenizer, data_path=data_path)
+
+        # load model
+        checkpoint = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+        model_args = ModelArgs()
+        model_args.n_layers = 32  # for debugging purposes we only use 1 layer
+        # torch.set_default_tensor_type(torch.cuda.HalfTensor) # for training we use fp32 weights
+        model = Llama(model_args)
+        model.load_state_dict(checkpoint, strict=False)
+        model.to("cuda")
+        # compile in place (rather than torch.compile(model)) so parameter names, and thus the saved
+        # lora_ keys, stay unprefixed; TransformerBlock already checkpoints activations in train mode
+        model.compile()
+
+        data_module = data_module_future.result()
+
     # create dataloader
-    data_module = make_supervised_data_module(tokenizer=tokenizer, data_path=data_path)
+    train_dataset = data_module["train_dataset"]
     dataloader = torch.utils.data.DataLoader(
-        data_module["train_dataset"],
-        batch_size=1,
+        train_dataset,
+        batch_sampler=LengthGroupedBatchSampler(train_dataset.lengths.tolist(), batch_size=16),
         collate_fn=data_module["data_collator"],
-        shuffle=True,
+        num_workers=4,
+        pin_memory=True,
+        persistent_workers=True,  # keep workers alive across epochs
+        prefetch_factor=4,
     )
+    dataloader = CudaPrefetcher(dataloader)
 
     for name, param in model.named_parameters():
         # print(name, param.requires_grad)
@@ -147,43 +310,35 @@ def train():
     trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print(f"Trainable params: {trainable_params}, percentage: {trainable_params / total_params * 100:.4f}%")
 
-    # prepare optimizer and loss function
-    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
-    criterion = torch.nn.CrossEntropyLoss(ignore_index=-100)
+    # prepare optimizer
+    # only the LoRA parameters need optimizer state; fused=True runs the update in one CUDA kernel
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-4, fused=True)
 
     # number of steps to accumulate gradients
     accumulation_steps = 8
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
 
     model.train()
 
-    # Gradient scaling to prevent underflow
-    scaler = GradScaler()
-
     for epoch in range(10):
         for i, batch in enumerate(dataloader):
-            input_ids = batch['input_ids'].to("cuda")
-            labels = batch['labels'].to("cuda")
+            input_ids = batch['input_ids']
+            labels = batch['labels']
 
-            # Runs forward pass with autocasting
-            with autocast(dtype=torch.float16):
+            # Runs forward pass with autocasting; bf16 has fp32's exponent range, so no loss scaling is needed
+            with torch.autocast("cuda", dtype=torch.bfloat16):
                 logits = model(input_ids)
 
-                shift_logits = logits[..., :-1, :].contiguous()
-                shift_labels = labels[..., 1:].contiguous()
-                shift_logits = shift_logits.view(-1, 32000)
-                shift_labels = shift_labels.view(-1)
+            # The model already returns fp32 logits, so the loss needs no autocast
+            loss = shifted_cross_entropy(logits, labels, accumulation_steps)
 
-                loss = criterion(shift_logits, shift_labels) / accumulation_steps
-            
-            # Accumulate scaled gradients
-            scaler.scale(loss).backward()
+            # Accumulate gradients
+            loss.backward()
 
             # Simulate a larger batch size (to accumulation_steps)
             if (i + 1) % accumulation_steps == 0 or (i + 1) == len(dataloader):
-                scaler.step(optimizer)
-                scaler.update()
-                optimizer.zero_grad()
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
 
             if i % 50 == 0:
                 # scale loss back for reporting
@@ -204,7 +359,7 @@ def train():
     # Save model state
     model_state_path = os.path.join(weights_save_path, "lora_weights_32.pth")
     # Only store lora layer states as we freeze the rest during training
-    lora_state_dict = {k: model.state_dict()[k] for k in model.state_dict() if 'lora_' in k}
+    lora_state_dict = {k: v.detach().cpu() for k, v in model.named_parameters() if 'lora_' in k}
     torch.save(lora_state_dict, model_state_path)
     print(f"Fine-tuned lora weights saved to {model_state_path}")
 
@@ -12,8 +12,8 @@ def inference():
 
     tokenizer = Tokenizer(tokenizer_path)
 
-    checkpoint = torch.load(model_path, map_location="cpu")
-    lora_state_dict = torch.load(lora_weights_path, map_location="cpu")
+    checkpoint = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+    lora_state_dict = torch.load(lora_weights_path, map_location="cpu", mmap=True, weights_only=True)
 
     model_args = ModelArgs()
     torch.set_default_tensor_type(torch.cuda.HalfTensor) # load model in fp16
@@ -44,7 +44,8 @@ def inference():
     ]
 
     model.eval()
-    results = model.generate(tokenizer, prompts, max_gen_len=64, temperature=0.6, top_p=0.9)
+    with torch.inference_mode():
+        results = model.generate(tokenizer, prompts, max_gen_len=64, temperature=0.6, top_p=0.9)
 
     for prompt, result in zip(prompts, results):
         print(prompt)
@@ -18,28 +18,35 @@ class Generation(nn.Module):
         eos_reached = torch.tensor([False] * bsz, device="cuda")
         input_text_mask = tokens != tokenizer.pad_id
 
-        for cur_pos in range(min_prompt_len, total_len):
-            with torch.no_grad():
-                logits = self(tokens[:, :cur_pos])
-            if temperature > 0:
-                probs = torch.softmax(logits[:, -1] / temperature, dim=-1)
-                next_token = self.sample_top_p(probs, top_p)
-            else:
-                next_token = torch.argmax(logits[:, -1], dim=-1)
+        # Feed only the new tokens each step; earlier keys/values come from the cache
+        self.setup_kv_cache(bsz, total_len)
+        try:
+            prev_pos = 0
+            for cur_pos in range(min_prompt_len, total_len):
+                with torch.inference_mode():
+                    logits = self(tokens[:, prev_pos:cur_pos], prev_pos)
+                if temperature > 0:
+                    probs = torch.softmax(logits[:, -1] / temperature, dim=-1)
+                    next_token = self.sample_top_p(probs, top_p)
+                else:
+                    next_token = torch.argmax(logits[:, -1], dim=-1)
 
-            next_token = next_token.reshape(-1)
-            # only replace token if prompt has already been generated
-            next_token = torch.where(
-                input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
-            )
-            tokens[:, cur_pos] = next_token
+                next_token = next_token.reshape(-1)
+                # only replace token if prompt has already been generated
+                next_token = torch.where(
+                    input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
+                )
+                tokens[:, cur_pos] = next_token
 
-            eos_reached |= (~input_text_mask[:, cur_pos]) & (
-                next_token == tokenizer.eos_id
-            )
- 
-            if all(eos_reached):
-                break
+                eos_reached |= (~input_text_mask[:, cur_pos]) & (
+                    next_token == tokenizer.eos_id
+                )
+                prev_pos = cur_pos
+
+                if all(eos_reached):
+                    break
+        finally:
+            self.clear_kv_cache()
 
         out_tokens = []
         for i, toks in enumerate(tokens.tolist()):
@@ -165,7 +165,7 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
 
 
 class Attention(nn.Module):
-    """Multi-head attention module without KV cache."""
+    """Multi-head attention module with an optional KV cache for generation."""
     def __init__(self, args: ModelArgs):
         """
         Initialize the Attention module.
@@ -183,8 +183,8 @@ class Attention(nn.Module):
             wk (ColumnParallelLinear): Linear transformation for keys.
             wv (ColumnParallelLinear): Linear transformation for values.
             wo (RowParallelLinear): Linear transformation for output.
-            Removed: cache_k (torch.Tensor): Cached keys for attention.
-            Removed: cache_v (torch.Tensor): Cached values for attention.
+            cache_k (torch.Tensor, optional): Cached keys for generation, None unless set up by setup_cache.
+            cache_v (torch.Tensor, optional): Cached values for generation, None unless set up by setup_cache.
         """
         super().__init__()
         self.n_kv_heads = args.n_heads if args.n_kv_heads is None else args.n_kv_heads
@@ -201,20 +201,43 @@ class Attention(nn.Module):
         self.wk = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
         self.wo = nn.Linear(args.n_heads * self.head_dim, args.dim, bias=False)
 
+        # Only allocated for the duration of a generate() call, training never uses them
+        self.cache_k = None
+        self.cache_v = None
+
+    def setup_cache(self, max_batch_size: int, max_seq_len: int):
+        """
+        Allocate the key/value cache used for incremental decoding.
+
+        Args:
+            max_batch_size (int): Number of sequences decoded together.
+            max_seq_len (int): Maximum number of positions (prompt + generation) to cache.
+
+        """
+        shape = (max_batch_size, max_seq_len, self.n_local_kv_heads, self.head_dim)
+        self.cache_k = self.wk.weight.new_zeros(shape)
+        self.cache_v = self.wk.weight.new_zeros(shape)
+
+    def clear_cache(self):
+        """Release the key/value cache."""
+        self.cache_k = None
+        self.cache_v = None
+
     def forward(
         self,
         x: torch.Tensor,
         freqs_cis: torch.Tensor,
         mask: Optional[torch.Tensor],
+        start_pos: int = 0,
     ):
         """
         Forward pass of the attention module.
 
         Args:
             x (torch.Tensor): Input tensor.
-            Removed: start_pos (int): Starting position for caching.
             freqs_cis (torch.Tensor): Precomputed frequency tensor.
             mask (torch.Tensor, optional): Attention mask tensor.
+            start_pos (int, optional): Starting position for caching, only used when the cache is set up. Defaults to 0.
 
         Returns:
             torch.Tensor: Output tensor after attention.
@@ -229,8 +252,14 @@ class Attention(nn.Module):
 
         xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
 
-        keys = xk.transpose(1, 2) # (bs, n_local_kv_heads, seqlen, head_dim)
-        values = xv.transpose(1, 2) # (bs, n_local_kv_heads, seqlen, head_dim)
+        if self.cache_k is not None:
+            self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk
+            self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv
+            xk = self.cache_k[:bsz, : start_pos + seqlen]
+            xv = self.cache_v[:bsz, : start_pos + seqlen]
+
+        keys = xk.transpose(1, 2) # (bs, n_local_kv_heads, cache_len + seqlen, head_dim)
+        values = xv.transpose(1, 2) # (bs, n_local_kv_heads, cache_len + seqlen, head_dim)
 
         # repeat k/v heads if n_kv_heads < n_heads
         keys = repeat_kv(keys, self.n_rep)  # (bs, seqlen, n_local_heads, head_dim)
@@ -324,15 +353,16 @@ class TransformerBlock(nn.Module):
         x: torch.Tensor,
         freqs_cis: torch.Tensor,
         mask: Optional[torch.Tensor],
+        start_pos: int = 0,
     ):
         """
         Perform a forward pass through the TransformerBlock.
 
         Args:
             x (torch.Tensor): Input tensor.
-            start_pos (int): Starting position for attention caching.
             freqs_cis (torch.Tensor): Precomputed cosine and sine frequencies.
             mask (torch.Tensor, optional): Masking tensor for attention. Defaults to None.
+            start_pos (int, optional): Starting position for attention caching. Defaults to 0.
 
         Returns:
             torch.Tensor: Output tensor after applying attention and feedforward layers.
@@ -345,7 +375,7 @@ class TransformerBlock(nn.Module):
 
         # Define helper functions for checkpointing
         def custom_attention(x, freqs_cis, mask):
-            return x + self.attention(self.attention_norm(x), freqs_cis, mask)
+            return x + self.attention(self.attention_norm(x), freqs_cis, mask, start_pos)
 
         def custom_feed_forward(h):
             return h + self.feed_forward(self.ffn_norm(h))
@@ -402,13 +432,30 @@ class Llama(Generation):
             self.params.dim // self.params.n_heads, self.params.max_seq_len * 2
         )
 
-    def forward(self, tokens: torch.Tensor):
+    def setup_kv_cache(self, max_batch_size: int, max_seq_len: int):
+        """
+        Allocate a key/value cache in every attention layer for incremental decoding.
+
+        Args:
+            max_batch_size (int): Number of sequences decoded together.
+            max_seq_len (int): Maximum number of positions (prompt + generation) to cache.
+
+        """
+        for layer in self.layers:
+            layer.attention.setup_cache(max_batch_size, max_seq_len)
+
+    def clear_kv_cache(self):
+        """Release the key/value cache of every attention layer."""
+        for layer in self.layers:
+            layer.attention.clear_cache()
+
+    def forward(self, tokens: torch.Tensor, start_pos: int = 0):
         """
         Perform a forward pass through the Transformer model.
 
         Args:
             tokens (torch.Tensor): Input token indices.
-            start_pos (int): Starting position for attention caching.
+            start_pos (int, optional): Starting position for attention caching. Defaults to 0.
 
         Returns:
             torch.Tensor: Output logits after applying the Transformer model.
@@ -417,7 +464,7 @@ class Llama(Generation):
         _bsz, seqlen = tokens.shape
         h = self.tok_embeddings(tokens)
         self.freqs_cis = self.freqs_cis.to(h.device)
-        freqs_cis = self.freqs_cis[:seqlen]
+        freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
 
         mask = None
         if seqlen > 1:
@@ -427,8 +474,17 @@ class Llama(Generation):
 
             mask = torch.triu(mask, diagonal=1)
 
+            # When performing key-value caching, we compute the attention scores
+            # only for the new sequence. Thus, the matrix of scores is of size
+            # (seqlen, cache_len + seqlen), and the only masked entries are (i, j) for
+            # j > cache_len + i, since row i corresponds to token cache_len + i.
+            mask = torch.hstack([
+                torch.zeros((seqlen, start_pos), device=tokens.device),
+                mask
+            ])
+
         for layer in self.layers:
-            h = layer(h, freqs_cis, mask)
+            h = layer(h, freqs_cis, mask, start_pos)
         h = self.norm(h)
         output = self.output(h).float()
         return output
@@ -22,6 +22,7 @@ class Tokenizer:
         """
         # reload tokenizer
         assert os.path.isfile(model_path), model_path
+        self.model_path = model_path
         self.sp_model = SentencePieceProcessor(model_file=model_path)
         logger.info(f"Reloaded SentencePiece model from {model_path}")
 
@@ -55,6 +56,21 @@ class Tokenizer:
             t = t + [self.eos_id]
         return t
 
+    def encode_batch(self, s: List[str], bos: bool, eos: bool) -> List[List[int]]:
+        """
+        Encodes a list of strings into lists of token IDs in a single SentencePiece call.
+
+        Args:
+            s (List[str]): The input strings to be encoded.
+            bos (bool): Whether to prepend the beginning-of-sequence token.
+            eos (bool): Whether to append the end-of-sequence token.
+
+        Returns:
+            List[List[int]]: A list of token ID lists, one per input string.
+        """
+        assert all(type(x) is str for x in s)
+        return self.sp_model.encode(s, out_type=int, add_bos=bos, add_eos=eos)
+
     def decode(self, t: List[int]) -> str:
         """
         Decodes a list of token IDs into a string.